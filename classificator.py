@@ -1,55 +1,308 @@
-from openpyxl import load_workbook
+import asyncio
+import enum
+import functools
+import json
+import math
+import os
+import re
+import sys
+import threading
+from collections import defaultdict
+
+import faiss
+import httpx
+import numpy as np
+import tiktoken
 from dotenv import load_dotenv
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+from langchain_openai import ChatOpenAI
+from langchain_core.exceptions import OutputParserException
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from langchain_core.runnables import RunnableLambda
 from langchain.agents import create_openai_functions_agent, AgentExecutor
 from langchain_community.tools.tavily_search import TavilySearchResults
+from openai import BadRequestError
+from pydantic import Field, ValidationError, create_model
+from python_calamine import CalamineWorkbook
+from rapidfuzz import fuzz, process
+from rapidfuzz.utils import default_process
+from sentence_transformers import SentenceTransformer
+
+# Load API keys
+load_dotenv()
+
+# Semantic cache of material information, persisted next to this module
+_SEMCACHE_DIR = os.path.dirname(os.path.abspath(__file__))
+_SEMCACHE_INDEX_FILE = os.path.join(_SEMCACHE_DIR, "material_information.faiss")
+_SEMCACHE_RESPONSES_FILE = os.path.join(_SEMCACHE_DIR, "material_information.jsonl")
+_SEMCACHE_THRESHOLD = 0.95
+_SEMCACHE_NEIGHBOURS = 5
+
+_SEMCACHE = None  # faiss.IndexFlatIP, created on first use
+_SEMCACHE_RESPONSES: list = []  # (material code, information) per index entry
+_SEMCACHE_LOCK = threading.Lock()
+_INFORMATION_CACHE: dict = {}  # Normalized material name matches
+
+# Token budget of the material description passed to the classification prompts
+_MAX_INFORMATION_TOKENS = 600
+
+# Local embedding model for the semantic cache and option classification
+_LOCAL_MODEL_NAME = "all-MiniLM-L6-v2"
+# Minimum cosine similarity lead of the best option before skipping the LLM
+_LOCAL_CLASSIFY_MARGIN = 0.05
+
+# Minimum probability of the LLM's answer to classify from the material name alone
+_CONFIDENT_PROBABILITY = 0.9
+
+# Minimum WRatio score for a fuzzy match to replace an answer without the LLM
+_FUZZY_MATCH_THRESHOLD = 70
+
+# Maximum number of material names sent in one batched classification call
+_BATCH_SIZE = 50
+
+# Column indexes of grade (A), category (F) and subcategory (G) in the material list
+_GRADE_COLUMN = 0
+_CATEGORY_COLUMN = 5
+_SUBCATEGORY_COLUMN = 6
+
+
+def _cache_once(maxsize=None):
+    """
+    Caches like functools.lru_cache, but only one thread computes a missing value.
+
+    functools caches let concurrent first calls all run the function, which
+    would load models and embed option lists once per batch worker.
+
+    Args:
+        maxsize (int): Maximum number of cached results, None for no limit.
+
+    Returns:
+        The decorator.
+    """
+
+    def decorator(function):
+        cached = functools.lru_cache(maxsize=maxsize)(function)
+        lock = threading.Lock()
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            with lock:
+                return cached(*args)
+
+        wrapper.cache_clear = cached.cache_clear
+        return wrapper
+
+    return decorator
+
+
+def _cell_value(value):
+    """
+    Converts a calamine cell value to the value stored in the material data.
+
+    Args:
+        value: The cell value returned by calamine.
+
+    Returns:
+        The cell value, None for empty cells and int for whole numbers.
+    """
+    if value == "":
+        return None
+    # Excel stores every number as a float
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _iter_material_rows(workbook: CalamineWorkbook, sheet_name: str):
+    """
+    Reads (category, subcategory, grade) tuples from a worksheet.
+
+    The worksheet is read by calamine into native Python values, without
+    creating cell objects. The header row is skipped.
+
+    Args:
+        workbook (CalamineWorkbook): The open Excel workbook.
+        sheet_name (str): Name of the worksheet.
+
+    Yields:
+        tuple: (category, subcategory, grade) for every data row.
+    """
+    sheet = workbook.get_sheet_by_name(sheet_name)
+    # Empty leading rows and columns are kept so column indexes stay fixed
+    for row in sheet.to_python(skip_empty_area=False)[1:]:
+        if len(row) <= _SUBCATEGORY_COLUMN:
+            continue  # Sheets without category columns hold no materials
+        yield (
+            _cell_value(row[_CATEGORY_COLUMN]),
+            _cell_value(row[_SUBCATEGORY_COLUMN]),
+            _cell_value(row[_GRADE_COLUMN]),
+        )
+
+
+def _intern(value):
+    """
+    Interns string values so repeated names share one object and its cached hash.
+    """
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _parse_sheet(
+    workbook: CalamineWorkbook, sheet_name: str, material_data_dict: defaultdict
+) -> None:
+    """
+    Adds the materials of one worksheet to material_data_dict.
+
+    Args:
+        workbook (CalamineWorkbook): The open Excel workbook.
+        sheet_name (str): Name of the worksheet.
+        material_data_dict (defaultdict): {category: {subcategory: {grades}}}.
+    """
+    for category, subcategory, grade in _iter_material_rows(workbook, sheet_name):
+        if grade is None:
+            continue  # Skip rows with empty grade cells, but don't break the loop
+
+        if not category or not subcategory or not grade:
+            continue  # Skip rows with missing required values
+
+        # Sets keep the duplicate check O(1) per row
+        material_data_dict[_intern(category)][_intern(subcategory)].add(_intern(grade))
+
+
+def _normalize_material_name(material_name) -> str:
+    """
+    Normalizes a material name for exact lookups, ignoring case, spaces and dashes.
+
+    Args:
+        material_name: The name of the material.
+
+    Returns:
+        str: The normalized name.
+    """
+    return re.sub(r"[\s\-]+", "", str(material_name)).lower()
+
+
+def _material_code(material_name) -> str:
+    """
+    Extracts the grade code of a material name, the words containing digits.
+
+    Names that differ in their code, like "AISI 304" and "AISI 304L", are
+    different materials however similar they look.
+
+    Args:
+        material_name: The name of the material.
+
+    Returns:
+        str: The sorted, lowercased words containing digits, joined by spaces.
+    """
+    words = re.findall(r"[a-z0-9]+", str(material_name).lower())
+    return " ".join(sorted(word for word in words if any(c.isdigit() for c in word)))
 
 
 def get_material_data(material_list_file) -> dict:
     """
-    Reads material data from an Excel file and organizes it into a nested dictionary.
+    Reads material data from all worksheets of an Excel file into parallel arrays.
+
+    Worksheets are parsed one after another into a single mapping.
+
+    Every unique (category, subcategory, grade) row is stored once: its grade
+    in "grades" and the ids of its category and subcategory at the same
+    position in "cat_of_grade" and "subcat_of_grade". Ids index into the
+    sorted "categories" and "subcategories" tuples.
 
     Args:
         material_list_file (str): Path to the Excel file containing material data.
 
     Returns:
-        dict: A dictionary organized as {category: {subcategory: [grades]}}.
+        dict: A dictionary with keys "categories", "subcategories", "grades",
+            "cat_of_grade", "subcat_of_grade", "category_ids", "subcategory_ids"
+            and "index", which maps normalized grade names to grade positions.
     """
-    try:
-        mat_wb = load_workbook(material_list_file, read_only=True)
-    except FileNotFoundError:
+    # calamine reports a missing file as a generic OSError
+    if not os.path.isfile(material_list_file):
         print(f"Error: File '{material_list_file}' not found.")
         return {}
+
+    material_data_dict: dict = defaultdict(lambda: defaultdict(set))
+    try:
+        workbook = CalamineWorkbook.from_path(material_list_file)
+        for sheet_name in workbook.sheet_names:
+            _parse_sheet(workbook, sheet_name, material_data_dict)
     except Exception as e:
         print(f"Error: Failed to load workbook: {e}")
         return {}
 
-    mat_ws = mat_wb.active
-    material_data_dict: dict = {}
+    # Names are stored once, rows refer to them by int32 id
+    categories = tuple(sorted(material_data_dict, key=str))
+    subcategories = tuple(
+        sorted(
+            {
+                subcategory
+                for subcategory_grades in material_data_dict.values()
+                for subcategory in subcategory_grades
+            },
+            key=str,
+        )
+    )
+    category_ids = {category: i for i, category in enumerate(categories)}
+    subcategory_ids = {subcategory: i for i, subcategory in enumerate(subcategories)}
 
-    for row in mat_ws.iter_rows(min_row=2):
-        if row[0].value is None:
-            continue  # Skip rows with empty grade cells, but don't break the loop
+    grades, cat_of_grade, subcat_of_grade = [], [], []
+    for category in categories:
+        for subcategory in sorted(material_data_dict[category], key=str):
+            for grade in sorted(material_data_dict[category][subcategory], key=str):
+                grades.append(grade)
+                cat_of_grade.append(category_ids[category])
+                subcat_of_grade.append(subcategory_ids[subcategory])
 
-        category = row[5].value
-        subcategory = row[6].value
-        grade = row[0].value
+    # Grades whose normalized name appears in several rows are left out
+    index: dict = {}
+    for position, grade in enumerate(grades):
+        key = _normalize_material_name(grade)
+        index[key] = None if key in index else position
 
-        if not category or not subcategory or not grade:
-            continue  # Skip rows with missing required values
+    return {
+        "categories": categories,
+        "subcategories": subcategories,
+        "grades": tuple(grades),
+        "cat_of_grade": np.array(cat_of_grade, dtype=np.int32),
+        "subcat_of_grade": np.array(subcat_of_grade, dtype=np.int32),
+        "category_ids": category_ids,
+        "subcategory_ids": subcategory_ids,
+        "index": {
+            key: position for key, position in index.items() if position is not None
+        },
+    }
 
-        if category not in material_data_dict:
-            material_data_dict[category] = {}
-        if subcategory not in material_data_dict[category]:
-            material_data_dict[category][subcategory] = []
-        if grade not in material_data_dict[category][subcategory]:
-            material_data_dict[category][subcategory].append(grade)
 
-    return material_data_dict
+def find_material(material_name: str, material_data: dict):
+    """
+    Looks up a material whose name matches a known grade.
 
+    Args:
+        material_name (str): The name of the material.
+        material_data (dict): A dictionary containing material data.
 
-def get_categories(material_data: dict) -> list:
+    Returns:
+        dict: The category, subcategory and grade of the matching material.
+        None: when the name does not match exactly one grade
+    """
+    position = material_data.get("index", {}).get(
+        _normalize_material_name(material_name)
+    )
+    if position is None:
+        return None
+    return {
+        "category": material_data["categories"][
+            material_data["cat_of_grade"][position]
+        ],
+        "subcategory": material_data["subcategories"][
+            material_data["subcat_of_grade"][position]
+        ],
+        "grade": material_data["grades"][position],
+    }
+
+
+def get_categories(material_data: dict) -> tuple:
     """
     Get the categories from the material data.
 
@@ -57,12 +310,12 @@ def get_categories(material_data: dict) -> list:
         material_data (dict): A dictionary containing material data.
 
     Returns:
-        list: A list of categories extracted from the material data.
+        tuple: The categories extracted from the material data.
     """
-    return material_data.keys()
+    return material_data.get("categories", ())
 
 
-def get_subcategories(material_data: dict, category: str) -> list:
+def get_subcategories(material_data: dict, category: str) -> tuple:
     """
     Get the subcategories for a given category from the material data.
 
@@ -71,12 +324,19 @@ def get_subcategories(material_data: dict, category: str) -> list:
         category (str): The category for which to retrieve subcategories.
 
     Returns:
-        list: A list of subcategories for the given category.
+        tuple: The subcategories for the given category.
     """
-    return material_data[category].keys()
+    in_category = (
+        material_data["cat_of_grade"] == material_data["category_ids"][category]
+    )
+    subcategories = material_data["subcategories"]
+    return tuple(
+        subcategories[i]
+        for i in np.unique(material_data["subcat_of_grade"][in_category])
+    )
 
 
-def get_grades(material_data: dict, category: str, subcategory: str) -> list:
+def get_grades(material_data: dict, category: str, subcategory: str) -> tuple:
     """
     Get the grades for a given category and subcategory from the material data.
 
@@ -86,9 +346,421 @@ def get_grades(material_data: dict, category: str, subcategory: str) -> list:
         subcategory (str): The subcategory of the material.
 
     Returns:
-        list: A list of grades for the given category and subcategory.
+        tuple: The grades for the given category and subcategory.
+    """
+    in_subcategory = (
+        material_data["cat_of_grade"] == material_data["category_ids"][category]
+    ) & (
+        material_data["subcat_of_grade"]
+        == material_data["subcategory_ids"][subcategory]
+    )
+    grades = material_data["grades"]
+    return tuple(grades[i] for i in np.flatnonzero(in_subcategory))
+
+
+# Prompt templates
+_INFORMATION_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "You are a material expert. Please describe the following material, focusing on its type and listing all material equivalents based on different standards. Return a string with a maximum of three sentences.",
+        ),
+        ("human", "{material}"),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+    ]
+)
+_CLASSIFY_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "For the material described below, choose an appropriate option from these options: {options}. Return only the exact name of the option from the list, without any extra words or characters.",
+        ),
+        ("human", "{material} is described: {material_information}"),
+    ]
+)
+_CLASSIFY_BATCH_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        (
+            "system",
+            "For each numbered material listed below, one per line, choose an appropriate option from these options: {options}. Return the number of the material and use only the exact name of the option from the list, without any extra words or characters.",
+        ),
+        ("human", "{materials}"),
+    ]
+)
+_CORRECT_PROMPT = ChatPromptTemplate.from_template(
+    "Correct this answer: {answer} so it is one of these options in this list {options}. Return only the exact name of the option from the list, without any extra words or characters.",
+)
+
+
+@_cache_once(maxsize=256)
+def _choice_schemas(options: tuple) -> tuple:
+    """
+    Builds structured output schemas that only accept the given options.
+
+    Args:
+        options (tuple): Options to choose from.
+
+    Returns:
+        tuple: (schema for one material, schema for a batch of materials).
+    """
+    # Options are rarely valid identifiers, so members are named by position
+    option_enum = enum.Enum(
+        "Option", {f"OPTION_{i}": str(option) for i, option in enumerate(options)}
+    )
+    option_field = (
+        option_enum,
+        Field(description="The exact name of the chosen option"),
+    )
+
+    choice = create_model("MaterialChoice", option=option_field)
+    classification = create_model(
+        "MaterialClassification",
+        number=(int, Field(description="The number of the material in the list")),
+        option=option_field,
+    )
+    classifications = create_model(
+        "MaterialClassifications", classifications=(list[classification], ...)
+    )
+    return choice, classifications
+
+
+# Option tuples whose schema the API rejected, e.g. enums above its size limit
+_REJECTED_SCHEMAS: set = set()
+
+
+def _reject_schema(options: tuple, error: BadRequestError) -> None:
+    """
+    Remembers that the API rejected the schema of an option list.
+
+    Args:
+        options (tuple): Options of the rejected schema.
+        error (BadRequestError): The error returned by the API.
+    """
+    # A prompt that is too long says nothing about the schema
+    if getattr(error, "code", None) != "context_length_exceeded":
+        _REJECTED_SCHEMAS.add(options)
+
+
+# Shared by the chat models so concurrent batches stay within API rate limits
+_RATE_LIMITER = InMemoryRateLimiter(
+    requests_per_second=10, check_every_n_seconds=0.1, max_bucket_size=10
+)
+
+
+# Clients are created on first use, so reading the material list needs no API keys
+@_cache_once()
+def _http_client() -> httpx.Client:
+    """
+    Returns the HTTP client shared by all OpenAI models to reuse connections.
+    """
+    return httpx.Client()
+
+
+@_cache_once()
+def _information_agent() -> AgentExecutor:
+    """
+    Returns the agent that searches for and describes a material.
+    """
+    # Agent setup
+    model = ChatOpenAI(
+        model="gpt-3.5-turbo-1106",
+        temperature=0.3,
+        http_client=_http_client(),
+        rate_limiter=_RATE_LIMITER,
+    )
+
+    # Search tool
+    search = TavilySearchResults(max_results=3)
+    tools = [search]
+
+    # Agent
+    agent = create_openai_functions_agent(model, tools, _INFORMATION_PROMPT)
+    return AgentExecutor(agent=agent, tools=tools)
+
+
+@_cache_once()
+def _classify_model() -> ChatOpenAI:
+    """
+    Returns the model used to choose an option for a material.
+    """
+    return ChatOpenAI(
+        model="gpt-3.5-turbo-1106",
+        temperature=0.1,
+        http_client=_http_client(),
+        rate_limiter=_RATE_LIMITER,
+    )
+
+
+@_cache_once()
+def _text_model() -> ChatOpenAI:
+    """
+    Returns the model used to answer with the name of an option as free text.
+
+    Its token logprobs tell how confident a choice from the name alone is.
+    """
+    return ChatOpenAI(
+        model="gpt-3.5-turbo-1106",
+        temperature=0.1,
+        logprobs=True,
+        http_client=_http_client(),
+        rate_limiter=_RATE_LIMITER,
+    )
+
+
+@_cache_once()
+def _correct_model() -> ChatOpenAI:
+    """
+    Returns the model used to correct answers that are not in the options.
+    """
+    return ChatOpenAI(
+        model="gpt-3.5-turbo",
+        temperature=0.2,
+        max_tokens=100,
+        verbose=True,
+        http_client=_http_client(),
+        rate_limiter=_RATE_LIMITER,
+    )
+
+
+@_cache_once(maxsize=256)
+def _classify_chains(options: tuple) -> tuple:
+    """
+    Builds the classification chains for one option list.
+
+    The options are formatted into the prompts once, so materials sharing an
+    option list reuse the same chains.
+
+    Args:
+        options (tuple): Options to choose from.
+
+    Returns:
+        tuple: (constrained chain for one material, free-text chain for one
+            material, constrained chain for a batch of materials).
+    """
+    formatted_options = ", ".join(str(option) for option in options)
+    choice_schema, classifications_schema = _choice_schemas(options)
+
+    prompt = _CLASSIFY_PROMPT.partial(options=formatted_options)
+    batch_prompt = _CLASSIFY_BATCH_PROMPT.partial(options=formatted_options)
+    return (
+        prompt
+        | _classify_model().with_structured_output(
+            choice_schema, method="function_calling", strict=True
+        ),
+        prompt | _text_model(),
+        batch_prompt
+        | _classify_model().with_structured_output(
+            classifications_schema, method="function_calling", strict=True
+        ),
+    )
+
+
+@_cache_once()
+def _local_embedder() -> SentenceTransformer:
+    """
+    Returns the local embedding model used by the semantic cache and classification.
+    """
+    return SentenceTransformer(_LOCAL_MODEL_NAME)
+
+
+def _embed(texts: list) -> np.ndarray:
+    """
+    Embeds texts with the local model.
+
+    Args:
+        texts (list): Texts to embed.
+
+    Returns:
+        np.ndarray: A (len(texts), dim) float32 array of unit vectors, so inner product is cosine similarity.
+    """
+    return (
+        _local_embedder()
+        .encode(list(texts), normalize_embeddings=True, convert_to_numpy=True)
+        .astype(np.float32)
+    )
+
+
+@_cache_once(maxsize=256)
+def _option_embeddings(options: tuple) -> np.ndarray:
+    """
+    Embeds the options once per option list.
+
+    Args:
+        options (tuple): Options to choose from.
+
+    Returns:
+        np.ndarray: One unit vector per option, in option order.
+    """
+    return _embed([str(option) for option in options])
+
+
+def _embed_material_name(material_name: str) -> np.ndarray:
+    """
+    Embeds a material name for the semantic cache.
+
+    Args:
+        material_name (str): The name of the material.
+
+    Returns:
+        np.ndarray: A (1, dim) float32 unit vector, so inner product is cosine similarity.
+    """
+    return _embed([material_name])
+
+
+def _load_semantic_cache() -> bool:
+    """
+    Loads the persisted semantic cache from disk once. Callers hold _SEMCACHE_LOCK.
+
+    Returns:
+        bool: False when persisted files exist but could not be read, so they
+            must not be overwritten.
+    """
+    global _SEMCACHE
+    if _SEMCACHE is not None:
+        return True
+    if not (
+        os.path.exists(_SEMCACHE_INDEX_FILE)
+        and os.path.exists(_SEMCACHE_RESPONSES_FILE)
+    ):
+        return True
+
+    # A read error may be transient, the files are kept for the next attempt
+    try:
+        index = faiss.read_index(_SEMCACHE_INDEX_FILE)
+        with open(_SEMCACHE_RESPONSES_FILE, encoding="utf-8") as responses_file:
+            records = [json.loads(line) for line in responses_file]
+        responses = [(record["code"], record["information"]) for record in records]
+    except Exception as e:
+        print(f"Error: Failed to load semantic cache: {e}")
+        return False
+
+    if index.d != _local_embedder().get_sentence_embedding_dimension():
+        _discard_semantic_cache("Semantic cache was built by another embedding model")
+        return True
+
+    _SEMCACHE = index
+    _SEMCACHE_RESPONSES.extend(responses)
+
+    # Interrupted writes leave one file ahead, keep the entries both files hold
+    complete = min(index.ntotal, len(_SEMCACHE_RESPONSES))
+    if index.ntotal != len(_SEMCACHE_RESPONSES):
+        if index.ntotal > complete:
+            index.remove_ids(np.arange(complete, index.ntotal, dtype="int64"))
+        del _SEMCACHE_RESPONSES[complete:]
+        _write_semantic_cache()
+    return True
+
+
+def _discard_semantic_cache(reason: str) -> None:
+    """
+    Removes persisted semantic cache files that cannot be used. Callers hold _SEMCACHE_LOCK.
+
+    Args:
+        reason (str): Why the cache is discarded.
     """
-    return material_data[category][subcategory]
+    print(f"Error: {reason}, starting with an empty one")
+    for path in (_SEMCACHE_INDEX_FILE, _SEMCACHE_RESPONSES_FILE):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _semantic_cache_search(embedding: np.ndarray, code: str):
+    """
+    Finds cached information for a similar material name with the same grade code.
+
+    Args:
+        embedding (np.ndarray): Embedding of the material name.
+        code (str): Grade code of the material name, see _material_code.
+
+    Returns:
+        The cached information of the most similar matching name, otherwise None.
+    """
+    with _SEMCACHE_LOCK:
+        _load_semantic_cache()
+        if _SEMCACHE is None or _SEMCACHE.ntotal == 0:
+            return None
+        similarities, positions = _SEMCACHE.search(
+            embedding, min(_SEMCACHE_NEIGHBOURS, _SEMCACHE.ntotal)
+        )
+        neighbours = [
+            _SEMCACHE_RESPONSES[position]
+            for similarity, position in zip(similarities[0], positions[0])
+            if position >= 0 and similarity >= _SEMCACHE_THRESHOLD
+        ]
+
+    # Similar looking names with another grade code are different materials
+    for cached_code, information in neighbours:
+        if cached_code == code:
+            return information
+    return None
+
+
+def _write_semantic_cache() -> None:
+    """
+    Persists the semantic cache. Callers hold _SEMCACHE_LOCK.
+
+    Each file is written to a temporary file and then replaced, so readers
+    never see a partly written file.
+    """
+    try:
+        responses_tmp = _SEMCACHE_RESPONSES_FILE + ".tmp"
+        with open(responses_tmp, "w", encoding="utf-8") as responses_file:
+            for code, information in _SEMCACHE_RESPONSES:
+                record = {"code": code, "information": information}
+                responses_file.write(json.dumps(record) + "\n")
+        index_tmp = _SEMCACHE_INDEX_FILE + ".tmp"
+        faiss.write_index(_SEMCACHE, index_tmp)
+        os.replace(responses_tmp, _SEMCACHE_RESPONSES_FILE)
+        os.replace(index_tmp, _SEMCACHE_INDEX_FILE)
+    except Exception as e:
+        print(f"Error: Failed to persist semantic cache: {e}")
+
+
+def _semantic_cache_add(embedding: np.ndarray, code: str, information: str) -> None:
+    """
+    Adds material information to the semantic cache and persists it.
+
+    Args:
+        embedding (np.ndarray): Embedding of the material name.
+        code (str): Grade code of the material name, see _material_code.
+        information (str): The material information to cache.
+    """
+    global _SEMCACHE
+    with _SEMCACHE_LOCK:
+        if not _load_semantic_cache():
+            return  # Unreadable files are not overwritten with a partial cache
+        if _SEMCACHE is None:
+            _SEMCACHE = faiss.IndexFlatIP(embedding.shape[1])
+        _SEMCACHE.add(embedding)
+        _SEMCACHE_RESPONSES.append((code, information))
+        _write_semantic_cache()
+
+
+@_cache_once()
+def _tokenizer() -> tiktoken.Encoding:
+    """
+    Returns the tokenizer used to measure material descriptions.
+    """
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """
+    Shortens a text to at most max_tokens tokens.
+
+    Args:
+        text (str): The text to shorten.
+        max_tokens (int): Maximum number of tokens to keep.
+
+    Returns:
+        str: The text, cut after max_tokens tokens when longer.
+    """
+    tokens = _tokenizer().encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return _tokenizer().decode(tokens[:max_tokens])
 
 
 def get_material_information(material_name: str) -> str:
@@ -109,32 +781,28 @@ def get_material_information(material_name: str) -> str:
         "Steel is a strong and durable material commonly used in construction and manufacturing. It is known for its high tensile strength and resistance to corrosion."
     """
 
-    # Load API keys
-    load_dotenv()
+    # Exact match needs no embedding
+    cache_key = _normalize_material_name(material_name)
+    if cache_key in _INFORMATION_CACHE:
+        return _INFORMATION_CACHE[cache_key]
 
-    # Agent setup
-    model = ChatOpenAI(model="gpt-3.5-turbo-1106", temperature=0.3)
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                "You are a material expert. Please describe the following material, focusing on its type and listing all material equivalents based on different standards. Return a string with a maximum of three sentences.",
-            ),
-            ("human", "{material}"),
-            MessagesPlaceholder(variable_name="agent_scratchpad"),
-        ]
-    )
+    # Similar material names with the same grade code share the description
+    code = _material_code(material_name)
+    embedding = _embed_material_name(material_name)
+    information = _semantic_cache_search(embedding, code)
+    if information is not None:
+        _INFORMATION_CACHE[cache_key] = information
+        return information
 
-    # Search tool
-    search = TavilySearchResults(max_results=3)
-    tools = [search]
-
-    # Agent
-    agent = create_openai_functions_agent(model, tools, prompt)
-    agent_executor = AgentExecutor(agent=agent, tools=tools)
+    # Only the description goes into the prompts, not the agent's inputs and steps
+    response = _information_agent().invoke({"material": material_name})
+    information = _truncate_to_tokens(
+        response.get("output", ""), _MAX_INFORMATION_TOKENS
+    )
 
-    response = agent_executor.invoke({"material": material_name})
-    return response
+    _semantic_cache_add(embedding, code, information)
+    _INFORMATION_CACHE[cache_key] = information
+    return information
 
 
 def classify_material(
@@ -150,34 +818,128 @@ def classify_material(
 
     Returns:
         str: The exact name of the chosen option from the list.
+        None: when no option could be chosen
+    """
+    # The prompt renders the information as text, so the text is the cache key
+    return _classify_material_cached(
+        material_name, str(material_information), tuple(options)
+    )
+
 
+def _local_choice(material_name: str, material_information: str, options: tuple):
     """
-    # Load API keys
-    load_dotenv()
+    Chooses an option by local embedding similarity when there is a clear winner.
 
-    # Agent setup
-    model = ChatOpenAI(model="gpt-3.5-turbo-1106", temperature=0.1)
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            (
-                "system",
-                "For the material described below, choose an appropriate option from these options: {options}. Return only the exact name of the option from the list, without any extra words or characters.",
-            ),
-            ("human", "{material} is described: {material_information}"),
-        ]
-    )
+    Args:
+        material_name (str): The name of the material.
+        material_information (str): The information about the material.
+        options (tuple): Options to choose from.
 
-    # agent = create_openai_functions_agent(llm=model, prompt=prompt, )
-    # agent_executor = AgentExecutor(agent=agent)
-    chain = prompt | model
-    response = chain.invoke(
-        {
-            "options": options,
-            "material": material_name,
-            "material_information": material_information,
-        }
-    )
-    return response.content
+    Returns:
+        The chosen option, None when no option wins by _LOCAL_CLASSIFY_MARGIN.
+    """
+    if len(options) == 1:
+        return options[0]
+    if not options:
+        return None
+    query = _embed([f"{material_name}: {material_information}"])[0]
+    scores = _option_embeddings(options) @ query
+    second, first = np.argsort(scores)[-2:]
+    if scores[first] - scores[second] > _LOCAL_CLASSIFY_MARGIN:
+        return options[first]
+    return None
+
+
+@functools.lru_cache(maxsize=4096)
+def _classify_material_cached(
+    material_name: str, material_information: str, options: tuple
+) -> str:
+    """
+    Cached implementation of classify_material keyed on hashable arguments.
+    """
+    # A clear winner by local embedding similarity needs no LLM call
+    option = _local_choice(material_name, material_information, options)
+    if option is not None:
+        return option
+
+    inputs = {
+        "material": material_name,
+        "material_information": material_information,
+    }
+
+    # Strict structured output restricts the answer to the options
+    choice_chain, text_chain, _ = _classify_chains(options)
+    response = None
+    if options not in _REJECTED_SCHEMAS:
+        try:
+            response = choice_chain.invoke(inputs)
+        except BadRequestError as e:
+            _reject_schema(options, e)
+        except (OutputParserException, ValidationError):
+            pass
+
+    if response is None:
+        # Option lists the API rejects as a schema are answered as free text
+        answer = text_chain.invoke(inputs).content
+        if answer in options:
+            return answer
+        return correct_answer_from_list(answer, options)
+
+    option_by_text = {str(option): option for option in options}
+    return option_by_text[response.option.value]
+
+
+def _answer_probability(message) -> float:
+    """
+    Computes the probability of an LLM answer from its token logprobs.
+
+    Args:
+        message: The AIMessage returned by the model.
+
+    Returns:
+        float: The probability of the whole answer, 0.0 when logprobs are missing.
+    """
+    logprobs = message.response_metadata.get("logprobs") or {}
+    tokens = logprobs.get("content") or []
+    if not tokens:
+        return 0.0
+    return math.exp(sum(token["logprob"] for token in tokens))
+
+
+def _classify_name_with_confidence(material_name: str, options: list) -> tuple:
+    """
+    Classifies a material from its name alone, if the choice is confident.
+
+    Args:
+        material_name (str): The name of the material.
+        options (list): A list of available options to choose from.
+
+    Returns:
+        tuple: (chosen option, True) when the name is enough, (None, False)
+            when the material information is needed.
+    """
+    return _classify_name_cached(material_name, tuple(options))
+
+
+@functools.lru_cache(maxsize=4096)
+def _classify_name_cached(material_name: str, options: tuple) -> tuple:
+    """
+    Cached implementation of _classify_name_with_confidence keyed on hashable
+    arguments.
+    """
+    option = _local_choice(material_name, "", options)
+    if option is not None:
+        return option, True
+
+    # Only the free-text answer carries logprobs of the option itself
+    _, text_chain, _ = _classify_chains(options)
+    message = text_chain.invoke({"material": material_name, "material_information": ""})
+    if (
+        message.content in options
+        and _answer_probability(message) > _CONFIDENT_PROBABILITY
+    ):
+        return message.content, True
+    return None, False
 
 
 def correct_answer_from_list(
@@ -195,45 +957,91 @@ def correct_answer_from_list(
         str: with corrected answer
         None: when fails
     """
+    return _correct_answer_from_list_cached(
+        answer, tuple(options), counter, max_attempts
+    )
 
-    # Load API keys
-    load_dotenv()
 
-    # Checks if the repeated correction counter is not capped
-    if counter >= max_attempts:
-        print(
-            f"correct_answer_from_list could not correct {answer} after {counter} attempts"
-        )
-        return None
-    model = ChatOpenAI(
-        model="gpt-3.5-turbo", temperature=0.2, max_tokens=100, verbose=True
+@functools.lru_cache(maxsize=256)
+def _processed_options(options: tuple) -> list:
+    """
+    Normalizes the options once for fuzzy matching.
+
+    Args:
+        options (tuple): Options to choose from.
+
+    Returns:
+        list: Processed options in the same order as the given options.
+    """
+    return [default_process(str(option)) for option in options]
+
+
+@functools.lru_cache(maxsize=4096)
+def _correct_answer_from_list_cached(
+    answer: str, options: tuple, counter: int, max_attempts: int
+) -> str:
+    """
+    Cached implementation of correct_answer_from_list keyed on hashable arguments.
+    """
+    # Near misses are corrected by string similarity, the LLM is the fallback
+    match = process.extractOne(
+        default_process(str(answer)),
+        _processed_options(options),
+        scorer=fuzz.WRatio,
+        processor=None,
     )
+    if match is not None and match[1] >= _FUZZY_MATCH_THRESHOLD:
+        return options[match[2]]
+
+    chain = _CORRECT_PROMPT | _correct_model()
 
-    # Prompt template
-    prompt = ChatPromptTemplate.from_template(
-        "Correct this answer: {answer} so it is one of these options in this list {options}. Return only the exact name of the option from the list, without any extra words or characters.",
+    # Repeats the correction until the answer is in the list or the counter is capped
+    while counter < max_attempts:
+        response = chain.invoke({"answer": answer, "options": options})
+
+        # Error handling when checking output type
+        try:
+            answer = str(response.content)
+        except TypeError:
+            print("correct_answer_from_list got wrong type of answer from llm")
+            return None
+        if answer in options:
+            return answer
+        counter += 1
+
+    print(
+        f"correct_answer_from_list could not correct {answer} after {counter} attempts"
     )
-    # Create llm chain
-    chain = prompt | model
-    response = chain.invoke({"answer": answer, "options": options})
+    return None
 
-    # Error handling when checking output type
-    try:
-        new_answer = str(response.content)
-        if new_answer in options:
-            return new_answer
-        else:
-            counter += 1
-            correct_answer_from_list(new_answer, options, counter)
-    except TypeError:
-        print("correct_answer_from_list got wrong type of answer from llm")
-        return None
+
+async def astart_workflow(material_name: str, material_db: dict):
+    """
+    Asynchronously classifies a material based on its name and information.
+
+    Runs start_workflow in a worker thread, so many materials can be
+    classified concurrently from an event loop.
+
+    Args:
+        material_name (str): The name of the material to be classified.
+        material_db (dict): The database containing material information.
+
+    Returns:
+        dict: A dictionary containing the classified category, subcategory, and grade of the material.
+    """
+    return await asyncio.to_thread(start_workflow, material_name, material_db)
 
 
 def start_workflow(material_name: str, material_db: dict):
     """
     Starts the workflow for classifying a material based on its name and information.
 
+    The category is classified from the material name first. The slow
+    material information search only runs when that choice is not confident,
+    and the category is then classified again with the information.
+    Subcategory and grade depend on the previous answer and are classified
+    one after another.
+
     Args:
         material_name (str): The name of the material to be classified.
         material_db (dict): The database containing material information.
@@ -241,48 +1049,329 @@ def start_workflow(material_name: str, material_db: dict):
     Returns:
         dict: A dictionary containing the classified category, subcategory, and grade of the material.
     """
+    # Known grades need no classification
+    known_material = find_material(material_name, material_db)
+    if known_material is not None:
+        return known_material
 
-    # Gather information
-    material_info = get_material_information(material_name)
-
-    # Get material category
+    # Get material category from the name alone
     categories = get_categories(material_db)
-    mat_category = classify_material(
-        material_name=material_name,
-        material_information=material_info,
-        categories=categories,
-    )
-    # Check if the output is chosen from given options
-    if mat_category not in categories:
-        mat_category = correct_answer_from_list(mat_category, categories)
-    # If correction failed
-    if not mat_category:
+    mat_category, confident = _classify_name_with_confidence(material_name, categories)
+
+    # Gather information only when the name is not enough
+    material_info = ""
+    if not confident:
+        material_info = get_material_information(material_name)
+        mat_category = classify_material(material_name, material_info, categories)
+
+    # Get subcategory, "Other" below a category missing from the database
+    mat_subcategory = None
+    subcategories = ()
+    if mat_category in categories:
+        subcategories = get_subcategories(
+            material_data=material_db, category=mat_category
+        )
+        mat_subcategory = classify_material(material_name, material_info, subcategories)
+    else:
         mat_category = "Other"
 
-    # Get subcategory
-    subcategories = get_subcategories(material_data=material_db, category=mat_category)
-    mat_subcategory = classify_material(material_name, material_info, subcategories)
-    # Check if the output is chosen from given options
-    if mat_subcategory not in subcategories:
-        mat_subcategory = correct_answer_from_list(mat_subcategory, subcategories)
-    # If correction failed
-    if not mat_subcategory:
+    # Get grade, "Other" below a subcategory missing from the database
+    mat_grade = None
+    if mat_subcategory in subcategories:
+        grades = get_grades(
+            material_data=material_db,
+            category=mat_category,
+            subcategory=mat_subcategory,
+        )
+        mat_grade = classify_material(material_name, material_info, grades)
+    else:
         mat_subcategory = "Other"
 
-    # Get grade
-    grades = get_grades(
-        material_data=material_db, category=mat_category, subcategory=mat_subcategory
-    )
-    mat_grade = classify_material(material_name, material_info, grades)
-    # Check if the output is chosen from given options
-    if mat_grade not in grades:
-        mat_grade = correct_answer_from_list(mat_grade, grades)
-    # If correction failed
-    if not mat_grade:
-        mat_grade = "Other"
-
     return {
         "category": mat_category,
         "subcategory": mat_subcategory,
-        "grade": mat_grade,
+        "grade": mat_grade or "Other",
+    }
+
+
+def _split_known_materials(material_names: list, material_db: dict) -> tuple:
+    """
+    Looks up the material names that are known grades of the database.
+
+    Args:
+        material_names (list): The names of the materials to be classified.
+        material_db (dict): The database containing material information.
+
+    Returns:
+        tuple: ({material_name: classification} of the known names, unique
+            names that still need classification, in input order).
+    """
+    results = {}
+    for material_name in material_names:
+        known_material = find_material(material_name, material_db)
+        if known_material is not None:
+            results[material_name] = known_material
+    unique_names = [
+        material_name
+        for material_name in dict.fromkeys(material_names)
+        if material_name not in results
+    ]
+    return results, unique_names
+
+
+def _ordered_results(material_names: list, results: dict, classifications) -> list:
+    """
+    Adds classifications to the known results and orders them like the input.
+
+    Args:
+        material_names (list): The names of the materials to be classified.
+        results (dict): {material_name: classification} of the known names.
+        classifications: (material_name, category, subcategory, grade) tuples.
+
+    Returns:
+        list: A dictionary with category, subcategory and grade for each material, in input order.
+    """
+    for material_name, mat_category, mat_subcategory, mat_grade in classifications:
+        results[material_name] = {
+            "category": mat_category,
+            "subcategory": mat_subcategory,
+            "grade": mat_grade,
+        }
+    return [dict(results[material_name]) for material_name in material_names]
+
+
+def start_workflow_many(
+    material_names: list, material_db: dict, concurrency: int = 10
+) -> list:
+    """
+    Classifies many materials, running the calls of each stage concurrently.
+
+    Every stage goes through Runnable.batch, so up to `concurrency` calls are
+    in flight at once instead of one material after another. As in
+    start_workflow, material information is only gathered for materials
+    whose category is not confident from the name alone.
+
+    Args:
+        material_names (list): The names of the materials to be classified.
+        material_db (dict): The database containing material information.
+        concurrency (int): Maximum number of concurrent calls per stage.
+
+    Returns:
+        list: A dictionary with category, subcategory and grade for each material, in input order.
+    """
+    config = {"max_concurrency": concurrency}
+
+    # Known grades need no classification
+    results, unique_names = _split_known_materials(material_names, material_db)
+    classify = RunnableLambda(lambda inputs: classify_material(**inputs))
+
+    # Get material categories from the names alone
+    categories = get_categories(material_db)
+    name_only_choices = RunnableLambda(
+        lambda material_name: _classify_name_with_confidence(material_name, categories)
+    ).batch(unique_names, config=config)
+    mat_categories = [mat_category for mat_category, _ in name_only_choices]
+
+    # Gather information only for materials the name is not enough for
+    uncertain = [
+        position
+        for position, (_, confident) in enumerate(name_only_choices)
+        if not confident
+    ]
+    material_infos = [""] * len(unique_names)
+    gathered_infos = RunnableLambda(get_material_information).batch(
+        [unique_names[position] for position in uncertain], config=config
+    )
+    for position, material_info in zip(uncertain, gathered_infos):
+        material_infos[position] = material_info
+    reclassified = classify.batch(
+        [
+            {
+                "material_name": unique_names[position],
+                "material_information": material_infos[position],
+                "options": categories,
+            }
+            for position in uncertain
+        ],
+        config=config,
+    )
+    for position, mat_category in zip(uncertain, reclassified):
+        mat_categories[position] = mat_category
+
+    # Get subcategories, "Other" below a category missing from the database
+    mat_subcategories = [None] * len(unique_names)
+    known_subcategories = [()] * len(unique_names)
+    for position, mat_category in enumerate(mat_categories):
+        if mat_category in categories:
+            known_subcategories[position] = get_subcategories(
+                material_data=material_db, category=mat_category
+            )
+        else:
+            mat_categories[position] = "Other"
+    known = [
+        position for position, options in enumerate(known_subcategories) if options
+    ]
+    classified = classify.batch(
+        [
+            {
+                "material_name": unique_names[position],
+                "material_information": material_infos[position],
+                "options": known_subcategories[position],
+            }
+            for position in known
+        ],
+        config=config,
+    )
+    for position, mat_subcategory in zip(known, classified):
+        mat_subcategories[position] = mat_subcategory
+
+    # Get grades, "Other" below a subcategory missing from the database
+    mat_grades = ["Other"] * len(unique_names)
+    known = []
+    for position, mat_subcategory in enumerate(mat_subcategories):
+        if mat_subcategory in known_subcategories[position]:
+            known.append(position)
+        else:
+            mat_subcategories[position] = "Other"
+    classified = classify.batch(
+        [
+            {
+                "material_name": unique_names[position],
+                "material_information": material_infos[position],
+                "options": get_grades(
+                    material_data=material_db,
+                    category=mat_categories[position],
+                    subcategory=mat_subcategories[position],
+                ),
+            }
+            for position in known
+        ],
+        config=config,
+    )
+    for position, mat_grade in zip(known, classified):
+        mat_grades[position] = mat_grade or "Other"
+
+    return _ordered_results(
+        material_names,
+        results,
+        zip(unique_names, mat_categories, mat_subcategories, mat_grades),
+    )
+
+
+def _classify_material_names(material_names: list, options) -> dict:
+    """
+    Chooses an option for each material name, sending many names per LLM call.
+
+    Args:
+        material_names (list): Unique names of the materials.
+        options (list): A list of available options to choose from.
+
+    Returns:
+        dict: {material_name: chosen option}, "Other" when no valid option was found.
+    """
+    options = tuple(options)
+    option_by_text = {str(option): option for option in options}
+
+    # Strict structured output forces one valid option per material
+    _, _, chain = _classify_chains(options)
+
+    choices = {}
+    for start in range(0, len(material_names), _BATCH_SIZE):
+        chunk = material_names[start : start + _BATCH_SIZE]
+        # Answers refer to line numbers, so reworded names still match
+        lines = [
+            f"{number}. {' '.join(str(material_name).split())}"
+            for number, material_name in enumerate(chunk, start=1)
+        ]
+        response = None
+        if options not in _REJECTED_SCHEMAS:
+            try:
+                response = chain.invoke({"materials": "\n".join(lines)})
+            except BadRequestError as e:
+                _reject_schema(options, e)
+            except (OutputParserException, ValidationError):
+                pass
+        if response is not None:
+            for classification in response.classifications:
+                if 1 <= classification.number <= len(chunk):
+                    material_name = chunk[classification.number - 1]
+                    choices.setdefault(
+                        material_name, option_by_text[classification.option.value]
+                    )
+
+        # Rejected schemas and materials left out are classified one by one
+        for material_name in chunk:
+            if material_name not in choices:
+                choices[material_name] = classify_material(material_name, "", options)
+
+    # If classification failed
+    return {
+        material_name: choices.get(material_name) or "Other"
+        for material_name in material_names
     }
+
+
+def classify_materials_batch(material_names: list, material_db: dict) -> list:
+    """
+    Classifies many materials at once based on their names.
+
+    Each stage sends the names in batches of _BATCH_SIZE per LLM call.
+    Subcategories and grades are classified per group of materials sharing
+    the same parent, so every call uses a single list of options.
+
+    Args:
+        material_names (list): The names of the materials to be classified.
+        material_db (dict): The database containing material information.
+
+    Returns:
+        list: A dictionary with category, subcategory and grade for each material, in input order.
+    """
+    # Known grades need no classification
+    results, unique_names = _split_known_materials(material_names, material_db)
+
+    # Get material categories
+    categories = get_categories(material_db)
+    mat_categories = _classify_material_names(unique_names, categories)
+
+    # Get subcategories, "Other" below a category missing from the database
+    names_by_category = defaultdict(list)
+    for material_name in unique_names:
+        names_by_category[mat_categories[material_name]].append(material_name)
+    mat_subcategories = {}
+    known_subcategories = {}
+    for category, names in names_by_category.items():
+        if category not in categories:
+            mat_subcategories.update(dict.fromkeys(names, "Other"))
+            continue
+        subcategories = get_subcategories(material_data=material_db, category=category)
+        known_subcategories[category] = subcategories
+        mat_subcategories.update(_classify_material_names(names, subcategories))
+
+    # Get grades, "Other" below a subcategory missing from the database
+    names_by_subcategory = defaultdict(list)
+    for material_name in unique_names:
+        parent = (mat_categories[material_name], mat_subcategories[material_name])
+        names_by_subcategory[parent].append(material_name)
+    mat_grades = {}
+    for (category, subcategory), names in names_by_subcategory.items():
+        if subcategory not in known_subcategories.get(category, ()):
+            mat_grades.update(dict.fromkeys(names, "Other"))
+            continue
+        grades = get_grades(
+            material_data=material_db, category=category, subcategory=subcategory
+        )
+        mat_grades.update(_classify_material_names(names, grades))
+
+    return _ordered_results(
+        material_names,
+        results,
+        (
+            (
+                material_name,
+                mat_categories[material_name],
+                mat_subcategories[material_name],
+                mat_grades[material_name],
+            )
+            for material_name in unique_names
+        ),
+    )